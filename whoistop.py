@@ -1,42 +1,169 @@
+import orjson
 import requests
+import requests_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import re
 import pandas as pd
 import time
 import csv
+import functools
+import os
 import logging
-from urllib.parse import urlparse
-from datetime import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from urllib.parse import urlsplit
+from datetime import datetime, timedelta
 
 # Configuração de logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Variáveis globais para controle de tempo
-ATRASO_BASE = 60  # 1 minuto em segundos
-ATRASO_PERSONALIZADO = 5  # 5 minutos
+# Limites de requisição por host (RDAP e ReceitaWS aceitam ~3 consultas por minuto)
+LIMITE_REQUISICOES = 3
+PERIODO_LIMITE = 60  # segundos
+MAX_WORKERS = 8  # domínios processados em paralelo
 CONTADOR_SUCESSO = 0
+LOCK_CSV = threading.Lock()
+FLUSH_A_CADA = 10  # linhas acumuladas antes de cada gravação no arquivo de saída
+
+COLUMNS = [
+    'Domain', 'Registration Name', 'Trade Name', 'Full Address', 'CEP', 'Phone',
+    'Status', 'Social Capital',
+    'Partner 1 Name', 'Partner 1 Qualification',
+    'Partner 2 Name', 'Partner 2 Qualification',
+    'RDAP Email', 'ReceitaWS Email'
+]
+
+# Expressão regular compilada uma única vez
+_RE_NONDIGIT = re.compile(r'\D')
+
+_TIPOS_DOCUMENTO = frozenset({'cpf', 'cnpj'})
+
+# Campos da ReceitaWS copiados por format_cnpj_info
+_CNPJ_KEYS = (
+    'nome', 'fantasia', 'logradouro', 'numero', 'bairro', 'municipio', 'uf',
+    'cep', 'telefone', 'situacao', 'capital_social', 'email'
+)
+
+class TokenBucket:
+    # Balde de fichas: repõe rate fichas por segundo até o limite de burst.
+    # Cada host tem o seu, então a cota de um não bloqueia as consultas ao outro.
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._fichas = burst
+        self._ultima = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        # Consome uma ficha e retorna 0, ou retorna quantos segundos faltam para a próxima
+        with self._lock:
+            agora = time.monotonic()
+            self._fichas = min(self.burst, self._fichas + (agora - self._ultima) * self.rate)
+            self._ultima = agora
+            if self._fichas >= 1:
+                self._fichas -= 1
+                return 0
+            return (1 - self._fichas) / self.rate
+
+    def acquire(self):
+        while True:
+            espera = self.try_acquire()
+            if not espera:
+                return
+            time.sleep(espera)
+
+# burst=1: com reposição de uma ficha a cada 20s, um balde cheio de 3 fichas
+# permitiria 5 consultas no primeiro minuto; assim nunca passam de 3 por janela
+BUCKETS = {
+    'rdap.registro.br': TokenBucket(rate=LIMITE_REQUISICOES / PERIODO_LIMITE, burst=1),
+    'receitaws.com.br': TokenBucket(rate=LIMITE_REQUISICOES / PERIODO_LIMITE, burst=1),
+}
+
+# Conexões simultâneas por host: retentativas com backoff não passam pelo
+# TokenBucket, então o semáforo impede que todas as threads insistam no mesmo host
+CONEXOES_POR_HOST = 2
+HOST_SEMAPHORES = {host: threading.BoundedSemaphore(CONEXOES_POR_HOST) for host in BUCKETS}
+
+# Sessão compartilhada: reaproveita conexões TCP/TLS entre as consultas e guarda
+# as respostas em disco, já que dados de registro mudam raramente
+TIMEOUT = (5, 30)  # (conexão, leitura) em segundos
+SESSION = requests_cache.CachedSession(
+    'rdap_cache',
+    backend='sqlite',
+    expire_after=timedelta(days=30),
+    urls_expire_after={
+        'rdap.registro.br': timedelta(days=30),
+        'receitaws.com.br': timedelta(days=7),
+    },
+    allowable_codes=(200, 404),
+)
+SESSION.headers.update({'User-Agent': 'herus/1.0 (+https://github.com/gbriellx/herus)'})
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=20,
+    # Em 429 a ReceitaWS informa Retry-After; a espera só acontece quando o limite é atingido
+    max_retries=Retry(
+        total=5,
+        status_forcelist=[429, 502, 503, 504],
+        allowed_methods=['GET'],
+        backoff_factor=2,
+        respect_retry_after_header=True,
+    )
+))
+
+def busca_url(url):
+    # Respostas em cache não consomem a cota de requisições
+    resposta = SESSION.get(url, timeout=TIMEOUT, only_if_cached=True)
+    if resposta.status_code == 504:  # não está em cache (ou expirou)
+        host = urlsplit(url).hostname
+        with HOST_SEMAPHORES[host]:
+            BUCKETS[host].acquire()
+            resposta = SESSION.get(url, timeout=TIMEOUT)
+    return resposta
 
 def consulta_rdap(dominio):
     url = f"https://rdap.registro.br/domain/{dominio}"
     
     try:
-        resposta = requests.get(url)
+        resposta = busca_url(url)
         resposta.raise_for_status()
-        return resposta.json()
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Erro na consulta RDAP para {dominio}: {str(e)}")
+        return orjson.loads(resposta.content)
+    except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
+        logging.error("Erro na consulta RDAP para %s: %s", dominio, e)
         return {"error": str(e)}
 
-def consulta_cnpj(cnpj):
+@functools.lru_cache(maxsize=4096)
+def _busca_cnpj(cnpj):
+    # Vários domínios costumam ter o mesmo CNPJ; só respostas válidas ficam em memória,
+    # pois exceções não são guardadas pelo lru_cache. O dict retornado é compartilhado.
     url = f"https://receitaws.com.br/v1/cnpj/{cnpj}"
-    
+    resposta = busca_url(url)
+    resposta.raise_for_status()
+    return orjson.loads(resposta.content)
+
+def consulta_cnpj(cnpj):
     try:
-        resposta = requests.get(url)
-        resposta.raise_for_status()
-        return resposta.json()
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Erro na consulta CNPJ {cnpj}: {str(e)}")
+        return _busca_cnpj(cnpj)
+    except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
+        logging.error("Erro na consulta CNPJ %s: %s", cnpj, e)
         return {"error": str(e)}
 
+def _vcard_map(entity):
+    # vcardArray tem o formato ["vcard", [itens...]]; indexa os itens pelo nome da
+    # propriedade, mantendo a primeira ocorrência. Ausente ou malformado vira dict vazio.
+    try:
+        vcard = entity['vcardArray'][1]
+    except (KeyError, IndexError, TypeError):
+        return {}
+    if not isinstance(vcard, list):
+        return {}
+    return {item[0]: item for item in reversed(vcard) if isinstance(item, list) and item}
+
+def _vcard_valor(vmap, propriedade):
+    item = vmap.get(propriedade)
+    return item[3] if item and len(item) > 3 else None
+
 def extract_key_info(rdap_info):
     email_rdap = None
     cpf_cnpj = None
@@ -49,21 +176,27 @@ def extract_key_info(rdap_info):
             'name': 'Error'
         }
 
-    for entity in rdap_info.get('entities', []):
+    # Percorre de trás para frente: o primeiro valor encontrado é o mesmo que a
+    # varredura completa em ordem manteria (o último), e dá para parar mais cedo
+    for entity in reversed(rdap_info.get('entities', [])):
         if 'registrant' in entity.get('roles', []):
-            vcard = entity.get('vcardArray', [[]])[1]
-            name = vcard[1][3] if len(vcard) > 1 and len(vcard[1]) > 3 else 'Not available'
-            for public_id in entity.get('publicIds', []):
-                if public_id['type'] in ['cpf', 'cnpj']:
-                    cpf_cnpj = public_id['identifier']
+            if name is None:
+                name = _vcard_valor(_vcard_map(entity), 'fn') or 'Not available'
+            if cpf_cnpj is None:
+                for public_id in reversed(entity.get('publicIds', [])):
+                    if public_id['type'] in _TIPOS_DOCUMENTO:
+                        cpf_cnpj = public_id['identifier']
+                        break
         
-        for sub_entity in entity.get('entities', []):
-            vcard = sub_entity.get('vcardArray', [[]])[1]
-            for item in vcard:
-                if item[0] == 'email':
-                    email_rdap = item[3]
+        if not email_rdap:
+            for sub_entity in reversed(entity.get('entities', [])):
+                email_rdap = _vcard_valor(_vcard_map(sub_entity), 'email')
+                if email_rdap:
                     break
 
+        if name and cpf_cnpj and email_rdap:
+            break
+
     return {
         'email_rdap': email_rdap if email_rdap else 'Not available',
         'cpf_cnpj': cpf_cnpj if cpf_cnpj else 'Not available',
@@ -71,42 +204,15 @@ def extract_key_info(rdap_info):
     }
 
 def format_cnpj_info(info):
-    return {
-        'nome': info.get('nome', 'Not available'),
-        'fantasia': info.get('fantasia', 'Not available'),
-        'logradouro': info.get('logradouro', 'Not available'),
-        'numero': info.get('numero', 'Not available'),
-        'bairro': info.get('bairro', 'Not available'),
-        'municipio': info.get('municipio', 'Not available'),
-        'uf': info.get('uf', 'Not available'),
-        'cep': info.get('cep', 'Not available'),
-        'telefone': info.get('telefone', 'Not available'),
-        'situacao': info.get('situacao', 'Not available'),
-        'capital_social': info.get('capital_social', 'Not available'),
-        'email': info.get('email', 'Not available'),
-        'qsa': info.get('qsa', [])
-    }
+    formatted = {chave: info.get(chave, 'Not available') for chave in _CNPJ_KEYS}
+    formatted['qsa'] = info.get('qsa', [])
+    return formatted
 
+@functools.lru_cache(maxsize=4096)
 def sanitize_cnpj(cnpj):
-    return re.sub(r'\D', '', cnpj)
-
-def save_to_csv(dominio, rdap_info, cnpj_info, filename):
-    global CONTADOR_SUCESSO
-    try:
-        df = pd.read_csv(filename)
-    except FileNotFoundError:
-        df = pd.DataFrame(columns=[
-            'Domain', 'Registration Name', 'Trade Name', 'Full Address', 'CEP', 'Phone',
-            'Status', 'Social Capital',
-            'Partner 1 Name', 'Partner 1 Qualification',
-            'Partner 2 Name', 'Partner 2 Qualification',
-            'RDAP Email', 'ReceitaWS Email'
-        ])
-
-    if dominio in df['Domain'].values:
-        logging.info(f"O domínio {dominio} já está na planilha. Não será pesquisado novamente.")
-        return False
+    return _RE_NONDIGIT.sub('', cnpj)
 
+def buffer_row(dominio, rdap_info, cnpj_info, rows_buffer, dominios_existentes):
     qsa = cnpj_info.get('qsa', [])
     new_row = {
         'Domain': dominio,
@@ -125,97 +231,154 @@ def save_to_csv(dominio, rdap_info, cnpj_info, filename):
         'ReceitaWS Email': cnpj_info.get('email', 'Not available')
     }
 
-    df = pd.concat([df, pd.DataFrame([new_row])], ignore_index=True)
-    df.to_csv(filename, index=False, encoding='utf-8')
-    logging.info(f"Informações do domínio {dominio} salvas com sucesso.")
-    CONTADOR_SUCESSO += 1
+    with LOCK_CSV:
+        if dominio in dominios_existentes:
+            logging.info("O domínio %s já está na planilha. Não será pesquisado novamente.", dominio)
+            return False
+        rows_buffer.append(new_row)
+        dominios_existentes.add(dominio)
     return True
 
+def flush_rows(writer, arquivo, rows_buffer):
+    global CONTADOR_SUCESSO
+    with LOCK_CSV:
+        if not rows_buffer:
+            return
+        writer.writerows(rows_buffer)
+        arquivo.flush()
+        for row in rows_buffer:
+            logging.info("Informações do domínio %s salvas com sucesso.", row['Domain'])
+        CONTADOR_SUCESSO += len(rows_buffer)
+        rows_buffer.clear()
+
 def clean_domains(domains):
-    cleaned_domains = []
     for domain in domains:
         domain = domain.strip().lower()
-        domain = re.sub(r'^https?://', '', domain)
-        domain = domain.rstrip('/')
-        domain = re.sub(r'^www\.', '', domain)
-        parsed = urlparse('http://' + domain)
-        domain_parts = parsed.netloc.split('.')
+        # A maioria das entradas já vem sem esquema nem www., então só corta quando precisa
+        if domain.startswith(('http://', 'https://')):
+            domain = domain.split('://', 1)[1]
+        if domain.startswith('www.'):
+            domain = domain[4:]
+        for separador in '/?#':  # remove caminho, query e fragmento
+            domain = domain.split(separador, 1)[0]
+        domain = domain.split(':', 1)[0]  # remove a porta
+        domain_parts = domain.split('.')
         if len(domain_parts) > 2:
             domain = '.'.join(domain_parts[-3:])
         else:
             domain = '.'.join(domain_parts)
         if domain.endswith('.br'):
-            cleaned_domains.append(domain)
-    return cleaned_domains
+            yield domain
+
+def pending_domains(cleaned_domains, dominios_existentes):
+    vistos = set()  # ignora domínios repetidos na entrada
+    for dominio in cleaned_domains:
+        if dominio in vistos:
+            continue
+        vistos.add(dominio)
+        if dominio in dominios_existentes:
+            logging.info("O domínio %s já está na planilha. Não será pesquisado novamente.", dominio)
+            continue
+        yield dominio
+
+def process_domain(dominio, rows_buffer, dominios_existentes):
+    logging.info("Processando domínio: %s", dominio)
+    
+    rdap_resultado = consulta_rdap(dominio)
+    
+    if isinstance(rdap_resultado, dict) and 'error' not in rdap_resultado:
+        key_info = extract_key_info(rdap_resultado)
+        logging.info("Domínio: %s - Dados RDAP recuperados com sucesso", dominio)
+        
+        if key_info['cpf_cnpj']:
+            cnpj_sanitizado = sanitize_cnpj(key_info['cpf_cnpj'])
+            if len(cnpj_sanitizado) == 14:
+                receita_info = consulta_cnpj(cnpj_sanitizado)
+                if isinstance(receita_info, dict) and 'error' not in receita_info:
+                    formatted_info = format_cnpj_info(receita_info)
+                    
+                    if buffer_row(dominio, key_info, formatted_info, rows_buffer, dominios_existentes):
+                        logging.info("Domínio: %s - Informações coletadas, aguardando gravação", dominio)
+                    else:
+                        logging.info("Domínio: %s - Informações não salvas (já existente)", dominio)
+                else:
+                    logging.error("Domínio: %s - Erro na consulta ReceitaWS: %s", dominio, receita_info.get('error', 'Erro desconhecido'))
+            else:
+                logging.warning("Domínio: %s - O CPF/CNPJ não é um CNPJ válido.", dominio)
+        else:
+            logging.warning("Domínio: %s - CNPJ não encontrado na consulta RDAP.", dominio)
+    else:
+        logging.error("Domínio: %s - Erro na consulta RDAP: %s", dominio, rdap_resultado.get('error', 'Erro desconhecido'))
 
 def main():
-    global CONTADOR_SUCESSO
     input_filename = 'dominios.csv'
     output_filename = 'informacoes_empresa.csv'
     
+    # Só a coluna Domain é necessária para saber o que já foi pesquisado
     try:
-        with open(input_filename, mode='r', encoding='utf-8') as file:
-            reader = csv.reader(file)
-            next(reader)
-            domains = [row[0] for row in reader if row]
-    except Exception as e:
-        logging.error(f"Erro ao ler o arquivo CSV: {e}")
-        return
+        df_existente = pd.read_csv(output_filename, usecols=['Domain'], dtype=str)
+        dominios_existentes = set(df_existente['Domain'])
+    except (FileNotFoundError, pd.errors.EmptyDataError):
+        dominios_existentes = set()
     
-    cleaned_domains = clean_domains(domains)
+    # Um arquivo já existente mantém o próprio cabeçalho para que as linhas novas fiquem alinhadas
+    arquivo_novo = not os.path.exists(output_filename) or os.path.getsize(output_filename) == 0
+    if arquivo_novo:
+        fieldnames = COLUMNS
+    else:
+        with open(output_filename, mode='r', encoding='utf-8', newline='') as file:
+            fieldnames = next(csv.reader(file))
     
+    # A entrada é lida linha a linha durante o processamento, sem carregar a lista inteira
     try:
-        df_existente = pd.read_csv(output_filename)
-        dominios_existentes = set(df_existente['Domain'])
-    except FileNotFoundError:
-        dominios_existentes = set()
+        arquivo_entrada = open(input_filename, mode='r', encoding='utf-8', newline='')
+    except OSError as e:
+        logging.error("Erro ao ler o arquivo CSV: %s", e)
+        return
     
-    for dominio in cleaned_domains:
-        if dominio in dominios_existentes:
-            logging.info(f"O domínio {dominio} já está na planilha. Não será pesquisado novamente.")
-            continue
-
-        inicio_processamento = time.time()
-        logging.info(f"Processando domínio: {dominio}")
-        
-        rdap_resultado = consulta_rdap(dominio)
-        time.sleep(10)  # Espera 10 segundos após a consulta RDAP
+    with arquivo_entrada:
+        reader = csv.reader(arquivo_entrada)
+        if next(reader, None) is None:
+            logging.error("Erro ao ler o arquivo CSV: %s está vazio", input_filename)
+            return
         
-        if isinstance(rdap_resultado, dict) and 'error' not in rdap_resultado:
-            key_info = extract_key_info(rdap_resultado)
-            logging.info(f"Domínio: {dominio} - Dados RDAP recuperados com sucesso")
+        with open(output_filename, mode='a', encoding='utf-8', newline='') as arquivo:
+            writer = csv.DictWriter(arquivo, fieldnames=fieldnames, restval='', extrasaction='ignore', lineterminator='\n')
+            if arquivo_novo:
+                writer.writeheader()
             
-            if key_info['cpf_cnpj']:
-                cnpj_sanitizado = sanitize_cnpj(key_info['cpf_cnpj'])
-                if len(cnpj_sanitizado) == 14:
-                    receita_info = consulta_cnpj(cnpj_sanitizado)
-                    time.sleep(10)  # Espera 10 segundos após a consulta CNPJ
-                    if isinstance(receita_info, dict) and 'error' not in receita_info:
-                        formatted_info = format_cnpj_info(receita_info)
-                        
-                        if save_to_csv(dominio, key_info, formatted_info, output_filename):
-                            logging.info(f"Domínio: {dominio} - Informações salvas com sucesso")
-                        else:
-                            logging.info(f"Domínio: {dominio} - Informações não salvas (já existente ou erro)")
-                    else:
-                        logging.error(f"Domínio: {dominio} - Erro na consulta ReceitaWS: {receita_info.get('error', 'Erro desconhecido')}")
-                else:
-                    logging.warning(f"Domínio: {dominio} - O CPF/CNPJ não é um CNPJ válido.")
-            else:
-                logging.warning(f"Domínio: {dominio} - CNPJ não encontrado na consulta RDAP.")
-        else:
-            logging.error(f"Domínio: {dominio} - Erro na consulta RDAP: {rdap_resultado.get('error', 'Erro desconhecido')}")
-        
-        # Calcula o tempo restante para completar 1 minuto
-        tempo_processamento = time.time() - inicio_processamento
-        tempo_espera = max(0, ATRASO_BASE - tempo_processamento)
-        time.sleep(tempo_espera)
-        
-        # Aplica o atraso personalizado a cada 5 domínios processados com sucesso
-        if CONTADOR_SUCESSO > 0 and CONTADOR_SUCESSO % 5 == 0:
-            logging.info(f"Aplicando atraso personalizado de {ATRASO_PERSONALIZADO} minutos após {CONTADOR_SUCESSO} domínios processados com sucesso.")
-            time.sleep(ATRASO_PERSONALIZADO * 60)
+            pendentes = pending_domains(clean_domains(row[0] for row in reader if row), dominios_existentes)
+            
+            # As linhas ficam em memória e são gravadas em lotes; o finally garante que
+            # um lote parcial seja salvo mesmo se o processamento for interrompido
+            rows_buffer = []
+            try:
+                # Os TokenBuckets limitam o ritmo das consultas; as threads apenas sobrepõem a espera de rede.
+                # No máximo 2 * MAX_WORKERS domínios ficam enfileirados por vez.
+                with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+                    try:
+                        em_andamento = set()
+                        for dominio in pendentes:
+                            if len(em_andamento) >= 2 * MAX_WORKERS:
+                                concluidos, em_andamento = wait(em_andamento, return_when=FIRST_COMPLETED)
+                                for futuro in concluidos:
+                                    futuro.result()
+                                if len(rows_buffer) >= FLUSH_A_CADA:
+                                    flush_rows(writer, arquivo, rows_buffer)
+                            em_andamento.add(executor.submit(process_domain, dominio, rows_buffer, dominios_existentes))
+                        for futuro in em_andamento:
+                            futuro.result()
+                    except BaseException:
+                        # Em Ctrl-C ou erro, descarta os domínios ainda na fila (cada um esperaria
+                        # sua vez no TokenBucket) e grava o que já foi coletado antes de aguardar
+                        # as threads em execução
+                        executor.shutdown(wait=False, cancel_futures=True)
+                        flush_rows(writer, arquivo, rows_buffer)
+                        raise
+            finally:
+                flush_rows(writer, arquivo, rows_buffer)
+    
+    logging.info("Processamento concluído: %s domínios salvos com sucesso.", CONTADOR_SUCESSO)
             
 if __name__ == "__main__":
     main()
-